@@ -0,0 +1,128 @@
+"""Micro-benchmark for post-processing of bulk MedCAT responses.
+
+Compares the original per-document filtering (list membership test against
+MEDICAL_CATEGORIES followed by sorted(list(set(...)))) with the single-pass
+extract_bulk_entity_names used by /datasets_bulk. MVCM is not called; medical
+names are passed through unexpanded in both cases.
+
+Both paths are timed from the same JSON response body: the original decodes
+it with json.loads and walks the dicts, the single pass reduces it to Entity
+records, either with parse_medcat_body (json.loads, as used for bodies below
+MEDCAT_STREAM_MIN_BYTES) or by streaming it through MedcatEntityParser.
+Post-processing alone is also reported, but the two start from different
+decoded forms (dicts vs Entity records).
+
+Run from the repository root:
+    PYTHONPATH=src python benchmarks/bench_annotation_filtering.py
+"""
+import json
+import random
+import timeit
+
+from ted_app.constant_medical import MEDICAL_CATEGORIES
+from ted_app.main import (
+    MedcatEntityParser,
+    extract_bulk_entity_names,
+    parse_medcat_body,
+)
+
+N_DATASETS = 200
+N_ENTITIES = 1000
+N_NAMES = 5000
+OTHER_CATEGORIES = ["Intellectual Product", "Spatial Concept", "Qualitative Concept"]
+
+
+def make_bulk_results(seed: int = 0):
+    rng = random.Random(seed)
+    categories = MEDICAL_CATEGORIES + OTHER_CATEGORIES * 10
+    results = []
+    for _ in range(N_DATASETS):
+        annotations = []
+        for i in range(N_ENTITIES):
+            status = "Affirmed" if rng.random() < 0.8 else "Other"
+            annotations.append(
+                {
+                    str(i): {
+                        "pretty_name": "term %d" % rng.randrange(N_NAMES),
+                        "types": rng.sample(categories, rng.randint(1, 2)),
+                        "meta_anns": {"Status": {"value": status}},
+                    }
+                }
+            )
+        results.append({"annotations": annotations})
+    return results
+
+
+def original(results):
+    all_terms = []
+    for result in results:
+        medical_terms = {}
+        other_terms = {}
+        for annotation in result["annotations"]:
+            for key, entity in annotation.items():
+                if entity["meta_anns"]["Status"]["value"] == "Affirmed":
+                    if any([t in MEDICAL_CATEGORIES for t in entity["types"]]):
+                        medical_terms[key] = entity
+                    else:
+                        other_terms[key] = entity
+        terms = [t["pretty_name"] for t in medical_terms.values()]
+        terms += [t["pretty_name"] for t in other_terms.values()]
+        all_terms.append(sorted(list(set(terms))))
+    return all_terms
+
+
+def original_from_body(body: bytes):
+    return original(json.loads(body)["result"])
+
+
+def parse_entities(body: bytes):
+    parser = MedcatEntityParser(bulk=True)
+    parser.feed(body)
+    return parser.close()
+
+
+def single_pass_from_body(body: bytes):
+    return single_pass(parse_medcat_body(body, bulk=True))
+
+
+def single_pass_from_stream(body: bytes):
+    return single_pass(parse_entities(body))
+
+
+def single_pass(medcat_entities):
+    medical_names, other_names = extract_bulk_entity_names(medcat_entities)
+    all_terms = []
+    for dataset_medical, dataset_other in zip(medical_names, other_names):
+        dataset_terms = set(dataset_medical)
+        dataset_terms.update(dataset_other)
+        all_terms.append(sorted(dataset_terms))
+    return all_terms
+
+
+def report(name: str, func, args, n_entities: int):
+    best = min(timeit.repeat(lambda: func(args), number=1, repeat=5))
+    print(
+        "%-40s %8.1f ms  (%.2f us/entity)"
+        % (name, best * 1e3, best * 1e6 / n_entities)
+    )
+
+
+if __name__ == "__main__":
+    results = make_bulk_results()
+    body = json.dumps({"result": results}).encode("utf-8")
+    medcat_entities = parse_entities(body)
+    assert original_from_body(body) == single_pass_from_body(body)
+    assert original_from_body(body) == single_pass_from_stream(body)
+    n_entities = N_DATASETS * N_ENTITIES
+    report("original, decode + post-process", original_from_body, body, n_entities)
+    report(
+        "single pass, decode + post-process", single_pass_from_body, body, n_entities
+    )
+    report(
+        "single pass, stream + post-process",
+        single_pass_from_stream,
+        body,
+        n_entities,
+    )
+    report("original, post-process only", original, results, n_entities)
+    report("single pass, post-process only", single_pass, medcat_entities, n_entities)
@@ -0,0 +1,99 @@
+"""Benchmark for decoding bulk MedCAT responses.
+
+Compares decoding the whole body with json.loads, as TED used to, with the
+two ways call_medcat_bulk reduces it to Entity records: parse_medcat_body,
+used for bodies below MEDCAT_STREAM_MIN_BYTES, and streaming through
+MedcatEntityParser, used for larger ones. Reports decode time and peak traced
+memory for each.
+
+Run from the repository root:
+    PYTHONPATH=src python benchmarks/bench_medcat_parsing.py
+"""
+import json
+import time
+import tracemalloc
+
+from ted_app.main import MedcatEntityParser, parse_medcat_body
+
+N_DATASETS = 50
+N_ENTITIES = 2000
+CHUNK_SIZE = 64 * 1024
+
+
+def make_entity(i: int):
+    return {
+        "pretty_name": "term %d" % i,
+        "cui": "C%07d" % i,
+        "type_ids": ["T047"],
+        "types": ["Disease or Syndrome"],
+        "source_value": "source value %d" % i,
+        "detected_name": "detected~name~%d" % i,
+        "acc": 0.9,
+        "context_similarity": 0.9,
+        "start": i * 10,
+        "end": i * 10 + 8,
+        "icd10": [],
+        "ontologies": ["SNOMED-CT"],
+        "snomed": [],
+        "id": i,
+        "meta_anns": {
+            "Status": {"value": "Affirmed", "confidence": 0.99, "name": "Status"}
+        },
+    }
+
+
+def make_body():
+    return json.dumps(
+        {
+            "result": [
+                {
+                    "text": "lorem ipsum " * 500,
+                    "annotations": [
+                        {str(i): make_entity(i)} for i in range(N_ENTITIES)
+                    ],
+                    "success": True,
+                }
+                for _ in range(N_DATASETS)
+            ],
+            "medcat_info": {},
+        }
+    ).encode("utf-8")
+
+
+def decode_whole_body(body: bytes):
+    return json.loads(body)["result"]
+
+
+def decode_to_entities(body: bytes):
+    return parse_medcat_body(body, bulk=True)
+
+
+def decode_streamed(body: bytes):
+    parser = MedcatEntityParser(bulk=True)
+    for i in range(0, len(body), CHUNK_SIZE):
+        parser.feed(body[i : i + CHUNK_SIZE])
+    return parser.close()
+
+
+def measure(func, body: bytes):
+    st = time.perf_counter()
+    func(body)
+    elapsed = time.perf_counter() - st
+    tracemalloc.start()
+    result = func(body)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    return elapsed, peak
+
+
+if __name__ == "__main__":
+    body = make_body()
+    print("body size %.1f MB" % (len(body) / 1e6))
+    for name, func in [
+        ("json.loads", decode_whole_body),
+        ("json.loads to entities", decode_to_entities),
+        ("streamed to entities", decode_streamed),
+    ]:
+        elapsed, peak = measure(func, body)
+        print("%-24s %8.1f ms  peak %7.1f MB" % (name, elapsed * 1e3, peak / 1e6))
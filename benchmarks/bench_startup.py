@@ -0,0 +1,110 @@
+"""Startup-time benchmark for a TED worker.
+
+Measures, in fresh interpreters:
+- the time taken to import ted_app.main, and
+- the time from launching a single uvicorn worker until /status answers,
+  which includes the import and application startup (lifespan).
+
+Run from the repository root:
+    PYTHONPATH=src python benchmarks/bench_startup.py [--repeats N]
+        [--max-import-ms MS] [--max-ready-ms MS]
+
+With a budget given, the script exits with status 1 when the median timing
+exceeds it, so that it can be used to catch cold start regressions.
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+IMPORT_SNIPPET = (
+    "import time; st = time.perf_counter(); import ted_app.main; "
+    "print(time.perf_counter() - st)"
+)
+
+
+def time_import():
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def time_until_ready(timeout_seconds: float = 30.0):
+    port = free_port()
+    st = time.perf_counter()
+    worker = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "ted_app.main:ted",
+            "--port",
+            str(port),
+            "--log-level",
+            "warning",
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - st < timeout_seconds:
+            if worker.poll() is not None:
+                raise RuntimeError("worker exited with code %d" % worker.returncode)
+            try:
+                with urllib.request.urlopen(
+                    "http://127.0.0.1:%d/status" % port, timeout=1
+                ) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - st
+            except OSError:
+                time.sleep(0.01)
+        raise TimeoutError("worker did not become ready in %fs" % timeout_seconds)
+    finally:
+        worker.terminate()
+        worker.wait()
+
+
+def summarise(name: str, timings: list[float], budget_ms=None):
+    """Print the timings and return whether their median is within budget_ms."""
+    median_ms = statistics.median(timings) * 1e3
+    print(
+        "%-16s median %7.1f ms  min %7.1f ms  max %7.1f ms"
+        % (name, median_ms, min(timings) * 1e3, max(timings) * 1e3)
+    )
+    if budget_ms is not None and median_ms > budget_ms:
+        print("%s median exceeds the budget of %.1f ms" % (name, budget_ms))
+        return False
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--max-import-ms", type=float, default=None)
+    parser.add_argument("--max-ready-ms", type=float, default=None)
+    args = parser.parse_args()
+
+    os.environ.setdefault("AUDIT_ENABLED", "0")
+    within_budget = summarise(
+        "import", [time_import() for _ in range(args.repeats)], args.max_import_ms
+    )
+    within_budget &= summarise(
+        "ready to serve",
+        [time_until_ready() for _ in range(args.repeats)],
+        args.max_ready_ms,
+    )
+    sys.exit(0 if within_budget else 1)
@@ -74,3 +74,5 @@ MEDICAL_CATEGORIES = [
     "Molecular Sequence",
     "Fully Formed Anatomical Structure",
 ]
+
+MEDICAL_CATEGORY_SET = frozenset(MEDICAL_CATEGORIES)
@@ -1,16 +1,22 @@
-from fastapi import FastAPI, status
-from google.cloud import pubsub_v1
+from fastapi import FastAPI, Request, Response, status
 from hdr_schemata.models.GWDM import Gwdm10, Gwdm11, Gwdm12, Gwdm20
 from hdr_schemata.models.GWDM.v2_0 import Summary
 
-from .constant_medical import MEDICAL_CATEGORIES
+from .constant_medical import MEDICAL_CATEGORY_SET
+from .profiling import PROFILING_ENABLED, ProfilingMiddleware, run_in_threadpool
+from .profiling import router as profiling_router
+import asyncio
 import time
 import os
-import requests
+import ijson
 import json
 import logging
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from typing import Union, Optional
+from typing import TYPE_CHECKING, NamedTuple, Union, Optional
+
+if TYPE_CHECKING:
+    import httpx
 
 load_dotenv()
 
@@ -21,20 +27,108 @@ MVCM_PASSWORD = os.getenv("MVCM_PASSWORD")
 PROJECT_ID = os.environ.get("PROJECT_ID", None)
 TOPIC_ID = os.environ.get("TOPIC_ID", None)
 AUDIT_ENABLED = True if os.environ.get("AUDIT_ENABLED", False) in [1, "1"] else False
+MVCM_CHUNK_SIZE = int(os.getenv("MVCM_CHUNK_SIZE", 50))
+MVCM_MAX_CONCURRENCY = int(os.getenv("MVCM_MAX_CONCURRENCY", 4))
+DISCONNECT_POLL_SECONDS = float(os.getenv("DISCONNECT_POLL_SECONDS", 1.0))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 100))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", 20))
+HTTP_POOL_TIMEOUT_SECONDS = float(os.getenv("HTTP_POOL_TIMEOUT_SECONDS", 30.0))
+MEDCAT_STREAM_MIN_BYTES = int(os.getenv("MEDCAT_STREAM_MIN_BYTES", 16 * 1024 * 1024))
+
+for name, value in [
+    ("MVCM_CHUNK_SIZE", MVCM_CHUNK_SIZE),
+    ("MVCM_MAX_CONCURRENCY", MVCM_MAX_CONCURRENCY),
+    ("HTTP_MAX_CONNECTIONS", HTTP_MAX_CONNECTIONS),
+    ("HTTP_MAX_KEEPALIVE_CONNECTIONS", HTTP_MAX_KEEPALIVE_CONNECTIONS),
+]:
+    if value < 1:
+        raise ValueError("%s must be at least 1, got %d" % (name, value))
+if MEDCAT_STREAM_MIN_BYTES < 0:
+    raise ValueError(
+        "MEDCAT_STREAM_MIN_BYTES must not be negative, got %d" % MEDCAT_STREAM_MIN_BYTES
+    )
+if HTTP_POOL_TIMEOUT_SECONDS <= 0:
+    raise ValueError(
+        "HTTP_POOL_TIMEOUT_SECONDS must be positive, got %f" % HTTP_POOL_TIMEOUT_SECONDS
+    )
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-ted = FastAPI()
+# Upstream clients are created when a worker starts up (see lifespan) rather
+# than at import time, and are otherwise built on first use.
+http_client = None
+mvcm_semaphore = None
+publisher = None
+topic_path = None
+
+
+def http_timeout(seconds: Optional[float]):
+    """Return a timeout of seconds (None for no timeout) for an upstream request,
+    which waits at most HTTP_POOL_TIMEOUT_SECONDS for a pooled connection.
+    """
+    import httpx
+
+    return httpx.Timeout(seconds, pool=HTTP_POOL_TIMEOUT_SECONDS)
+
+
+def get_http_client():
+    """Return the HTTP client shared by all calls to MedCAT and MVCM."""
+    global http_client
+    if http_client is None:
+        # Importing httpx is slow, so only do it when the client is first needed
+        import httpx
+
+        http_client = httpx.AsyncClient(
+            timeout=http_timeout(None),
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            ),
+        )
+    return http_client
+
+
+def get_publisher():
+    """Return the audit PubSub publisher client and the topic path to publish to."""
+    global publisher, topic_path
+    if publisher is None:
+        # Importing the PubSub client is slow, so only do it when auditing is on
+        from google.cloud import pubsub_v1
+
+        publisher = pubsub_v1.PublisherClient()
+        # The `topic_path` method creates a fully qualified identifier
+        # in the form `projects/{PROJECT_ID}/topics/{TOPIC_ID}`
+        topic_path = publisher.topic_path(PROJECT_ID, TOPIC_ID)
+    return publisher, topic_path
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client
+    get_http_client()
+    if AUDIT_ENABLED:
+        get_publisher()
+    yield
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+
+
+ted = FastAPI(lifespan=lifespan)
+
+if PROFILING_ENABLED:
+    ted.add_middleware(ProfilingMiddleware)
+    ted.include_router(profiling_router)
 
 Dataset = Union[Gwdm10, Gwdm11, Gwdm12, Gwdm20]
 
+# Nginx's "client closed request" status, returned when the caller has gone away.
+HTTP_499_CLIENT_CLOSED_REQUEST = 499
 
-if AUDIT_ENABLED:
-    publisher = pubsub_v1.PublisherClient()
-    # The `topic_path` method creates a fully qualified identifier
-    # in the form `projects/{PROJECT_ID}/topics/{TOPIC_ID}`
-    topic_path = publisher.topic_path(PROJECT_ID, TOPIC_ID)
+# Counters are kept per uvicorn worker process; /metrics reports those of the
+# worker that answers, identified by its pid.
+metrics = {"cancelled_requests": 0}
 
 
 def publish_message(action_type="", action_name="", description=""):
@@ -47,6 +141,7 @@ def publish_message(action_type="", action_name="", description=""):
             "created_at": int(time.time() * 10e6),
         }
         encoded_json = json.dumps(message_json).encode("utf-8")
+        publisher, topic_path = get_publisher()
         future = publisher.publish(topic_path, encoded_json)
         return future.result()
 
@@ -121,134 +216,455 @@ def preprocess_dataset(dataset: Dataset):
     return document
 
 
-def call_medcat(document: str, timeout_seconds: int = 600):
+def preprocess_datasets(datasets: list[Dataset]):
+    return [preprocess_dataset(dataset) for dataset in datasets]
+
+
+class Entity(NamedTuple):
+    """The fields of a MedCAT annotation that TED uses."""
+
+    key: str
+    pretty_name: str
+    types: tuple
+    status: str
+
+
+class MedcatResponseError(Exception):
+    """Raised when a MedCAT response does not contain the expected results."""
+
+
+class MedcatEntityParser:
+    """Incrementally parse a MedCAT response body into Entity records.
+
+    Bytes are fed to an ijson parser and only the parse events for an entity's
+    pretty_name, types and Status meta annotation are kept, so no other part of
+    the response is assembled into Python objects. For bulk responses each
+    document in `result` starts a new list of entities.
+    """
+
+    def __init__(self, bulk: bool = False):
+        if bulk:
+            self.document_prefix = "result.item"
+            self.annotations_prefix = "result.item.annotations"
+            self.documents = []
+        else:
+            self.document_prefix = None
+            self.annotations_prefix = "result.annotations"
+            self.documents = [[]]
+        self.annotation_prefix = self.annotations_prefix + ".item"
+        self.annotations_seen = 0
+        self.entity_prefix = None
+        self.pretty_name_prefix = None
+        self.types_prefix = None
+        self.status_prefix = None
+        self.events = ijson.sendable_list()
+        self.parser = ijson.parse_coro(self.events, use_float=True)
+
+    def start_entity(self, key: str):
+        self.key = key
+        self.entity_prefix = "%s.%s" % (self.annotation_prefix, key)
+        self.pretty_name_prefix = self.entity_prefix + ".pretty_name"
+        self.types_prefix = self.entity_prefix + ".types.item"
+        self.status_prefix = self.entity_prefix + ".meta_anns.Status.value"
+        self.pretty_name = None
+        self.types = []
+        self.status = None
+
+    def handle_events(self):
+        for prefix, event, value in self.events:
+            if prefix == self.pretty_name_prefix:
+                self.pretty_name = value
+            elif prefix == self.types_prefix:
+                self.types.append(value)
+            elif prefix == self.status_prefix:
+                self.status = value
+            elif prefix == self.entity_prefix:
+                if event == "end_map":
+                    self.documents[-1].append(
+                        Entity(
+                            self.key, self.pretty_name, tuple(self.types), self.status
+                        )
+                    )
+                    self.entity_prefix = None
+                    self.pretty_name_prefix = None
+                    self.types_prefix = None
+                    self.status_prefix = None
+            elif prefix == self.annotation_prefix:
+                if event == "map_key":
+                    self.start_entity(value)
+            elif prefix == self.annotations_prefix:
+                if event == "start_array":
+                    self.annotations_seen += 1
+            elif prefix == self.document_prefix:
+                if event == "start_map":
+                    self.documents.append([])
+        del self.events[:]
+
+    def feed(self, chunk: bytes):
+        self.parser.send(chunk)
+        self.handle_events()
+
+    def close(self):
+        """Finish parsing and return the entities of each document."""
+        self.parser.close()
+        self.handle_events()
+        if self.annotations_seen != len(self.documents):
+            raise MedcatResponseError(
+                "MedCAT returned annotations for %d of %d documents"
+                % (self.annotations_seen, len(self.documents))
+            )
+        return self.documents
+
+
+def entities_from_annotations(annotations: list[dict]):
+    """Reduce decoded MedCAT annotations, dicts of entity id to entity, to Entity
+    records.
+    """
+    return [
+        Entity(
+            key,
+            entity["pretty_name"],
+            tuple(entity["types"]),
+            entity.get("meta_anns", {}).get("Status", {}).get("value"),
+        )
+        for annotation in annotations
+        for key, entity in annotation.items()
+    ]
+
+
+def parse_medcat_body(body: bytes, bulk: bool = False):
+    """Decode a whole MedCAT response body at once and return the entities found
+    in each document, as MedcatEntityParser does.
+    """
+    try:
+        result = json.loads(body)["result"]
+        return [
+            entities_from_annotations(dataset_resp["annotations"])
+            for dataset_resp in (result if bulk else [result])
+        ]
+    except (KeyError, TypeError) as e:
+        raise MedcatResponseError("MedCAT response has no annotations: %r" % e)
+
+
+async def read_medcat_entities(response: "httpx.Response", bulk: bool = False):
+    """Check the status of a streamed MedCAT response and parse its body into
+    the entities found in each document. Parsing is done in the threadpool so
+    that large responses do not block the event loop.
+
+    Streaming the body through MedcatEntityParser keeps peak memory low but
+    takes more CPU than json.loads, so only bodies of at least
+    MEDCAT_STREAM_MIN_BYTES (or of unknown length) are streamed.
+    """
+    response.raise_for_status()
+    content_length = response.headers.get("Content-Length")
+    if content_length is not None and int(content_length) < MEDCAT_STREAM_MIN_BYTES:
+        body = await response.aread()
+        return await run_in_threadpool(parse_medcat_body, body, bulk)
+
+    parser = MedcatEntityParser(bulk)
+    async for chunk in response.aiter_bytes():
+        await run_in_threadpool(parser.feed, chunk)
+    return await run_in_threadpool(parser.close)
+
+
+async def call_medcat(document: str, timeout_seconds: int = 600):
     """Call the MedCATservice to perform named entity recognition on document and
-    return the response json.
+    return the entities found.
     """
     api_url = "%s/api/process" % (MEDCAT_HOST)
 
-    response = requests.post(
+    async with get_http_client().stream(
+        "POST",
         api_url,
         json={"content": {"text": document}},
         headers={"Content-Type": "application/json"},
-        timeout=timeout_seconds,
-    )
-    return response.json()
+        timeout=http_timeout(timeout_seconds),
+    ) as response:
+        return (await read_medcat_entities(response))[0]
 
 
-def call_medcat_bulk(documents: list[str]):
+async def call_medcat_bulk(documents: list[str]):
     """Call the MedCATservice to perform named entity recognition on documents
-    and return the response json.
+    and return the entities found in each document.
     """
     api_url = "%s/api/process_bulk" % (MEDCAT_HOST)
-    response = requests.post(
+    async with get_http_client().stream(
+        "POST",
         api_url,
         json={"content": [{"text": doc} for doc in documents]},
         headers={"Content-Type": "application/json"},
-    )
-    return response.json()
+    ) as response:
+        medcat_entities = await read_medcat_entities(response, bulk=True)
+    if len(medcat_entities) != len(documents):
+        raise MedcatResponseError(
+            "MedCAT returned results for %d of %d documents"
+            % (len(medcat_entities), len(documents))
+        )
+    return medcat_entities
 
 
-def extract_medical_entities(annotations: dict):
+def extract_medical_entities(entities: list[Entity]):
     medical_terms = {}
     other_terms = {}
-    for annotation in annotations:
-        for key, entity in annotation.items():
-            if entity["meta_anns"]["Status"]["value"] == "Affirmed":
-                if any([t in MEDICAL_CATEGORIES for t in entity["types"]]):
-                    medical_terms[key] = entity
-                else:
-                    other_terms[key] = entity
+    for entity in entities:
+        if entity.status == "Affirmed":
+            if not MEDICAL_CATEGORY_SET.isdisjoint(entity.types):
+                medical_terms[entity.key] = entity
+            else:
+                other_terms[entity.key] = entity
     return medical_terms, other_terms
 
 
-def call_mvcm(medical_terms: dict):
+def extract_bulk_entity_names(medcat_results: list[list[Entity]]):
+    """Split the affirmed entities of every document in a bulk MedCAT response
+    into medical and other pretty_names in a single pass. Names are de-duplicated
+    per document (keeping first-seen order) and entity types are only classified
+    once per distinct combination.
+    """
+    medical_types = {}
+    medical_names = []
+    other_names = []
+    for entities in medcat_results:
+        doc_medical = {}
+        doc_other = {}
+        for entity in entities:
+            if entity.status != "Affirmed":
+                continue
+            is_medical = medical_types.get(entity.types)
+            if is_medical is None:
+                is_medical = not MEDICAL_CATEGORY_SET.isdisjoint(entity.types)
+                medical_types[entity.types] = is_medical
+            if is_medical:
+                doc_medical[entity.pretty_name] = None
+            else:
+                doc_other[entity.pretty_name] = None
+        medical_names.append(list(doc_medical))
+        other_names.append(list(doc_other))
+    return medical_names, other_names
+
+
+def get_mvcm_semaphore():
+    """Return the semaphore bounding the MVCM requests in flight from this
+    worker. It is bound to the running event loop, so a new one is created if
+    the loop changes (e.g. between tests).
+    """
+    global mvcm_semaphore
+    loop = asyncio.get_running_loop()
+    if mvcm_semaphore is None or mvcm_semaphore[0] is not loop:
+        mvcm_semaphore = (loop, asyncio.Semaphore(MVCM_MAX_CONCURRENCY))
+    return mvcm_semaphore[1]
+
+
+async def call_mvcm_chunk(client: "httpx.AsyncClient", pretty_names: list[str]):
+    """Post one chunk of named entities to the medical vocabulary concept mapping
+    service and return the related medical concepts found for them.
+    """
+    mvcm_url = "%s/search/omop/" % (MVCM_HOST)
+    response = await client.post(
+        mvcm_url,
+        json={
+            "search_terms": pretty_names,
+            "vocabulary_id": "",
+            "concept_ancestor": "y",
+            "max_separation_descendant": 0,
+            "max_separation_ancestor": 1,
+            "concept_relationship": "n",
+            "concept_synonym": "n",
+            "search_threshold": 95
+        },
+        auth=(MVCM_USER, MVCM_PASSWORD),
+    )
+    response.raise_for_status()
+    expanded_terms_list = []
+    for term in response.json():
+        if term["CONCEPT"] is not None:
+            for concept in term["CONCEPT"]:
+                expanded_terms_list.append(concept["concept_name"])
+                expanded_terms_list.append(concept["concept_code"])
+                expanded_terms_list += [
+                    syn["concept_synonym_name"] for syn in concept["CONCEPT_SYNONYM"]
+                ]
+                expanded_terms_list += [
+                    ancestor["concept_name"] for ancestor in concept["CONCEPT_ANCESTOR"]
+                ]
+                expanded_terms_list += [
+                    ancestor["concept_code"] for ancestor in concept["CONCEPT_ANCESTOR"]
+                ]
+    return expanded_terms_list
+
+
+async def call_mvcm(pretty_names: list[str]):
     """Call the medical vocabulary concept mapping service to expand the list of
     named entities. Return a combined list of original named entities and related
     medical concepts.
+
+    The names are sent in chunks of MVCM_CHUNK_SIZE. At most MVCM_MAX_CONCURRENCY
+    chunks are in flight at a time across all requests served by this worker.
+    A chunk that fails contributes only its original named entities.
     """
-    pretty_names = [t["pretty_name"] for t in medical_terms.values()]
-    mvcm_url = "%s/search/omop/" % (MVCM_HOST)
     if len(pretty_names) == 0:
         return pretty_names
-    try:
-        response = requests.post(
-            mvcm_url,
-            json={
-                "search_terms": pretty_names,
-                "vocabulary_id": "",
-                "concept_ancestor": "y",
-                "max_separation_descendant": 0,
-                "max_separation_ancestor": 1,
-                "concept_relationship": "n",
-                "concept_synonym": "n",
-                "search_threshold": 95
-            },
-            auth=requests.auth.HTTPBasicAuth(MVCM_USER, MVCM_PASSWORD),
-        )
-        expanded_terms_list = []
-        for term in response.json():
-            if term["CONCEPT"] is not None:
-                for concept in term["CONCEPT"]:
-                    expanded_terms_list.append(concept["concept_name"])
-                    expanded_terms_list.append(concept["concept_code"])
-                    expanded_terms_list += [
-                        syn["concept_synonym_name"]
-                        for syn in concept["CONCEPT_SYNONYM"]
-                    ]
-                    expanded_terms_list += [
-                        ancestor["concept_name"]
-                        for ancestor in concept["CONCEPT_ANCESTOR"]
-                    ]
-                    expanded_terms_list += [
-                        ancestor["concept_code"]
-                        for ancestor in concept["CONCEPT_ANCESTOR"]
-                    ]
-
-        return pretty_names + expanded_terms_list
-    except Exception:
-        print(
-            """
-        WARNING: failed to access medical vocab mapping service, returning 
-        original list of named entities.
-        """
+    chunks = [
+        pretty_names[i : i + MVCM_CHUNK_SIZE]
+        for i in range(0, len(pretty_names), MVCM_CHUNK_SIZE)
+    ]
+    semaphore = get_mvcm_semaphore()
+
+    async def expand_chunk(client: "httpx.AsyncClient", chunk: list[str]):
+        async with semaphore:
+            st = time.time()
+            try:
+                return await call_mvcm_chunk(client, chunk), None, time.time() - st
+            except Exception as e:
+                return [], e, time.time() - st
+
+    client = get_http_client()
+    results = await asyncio.gather(*[expand_chunk(client, chunk) for chunk in chunks])
+
+    expanded_terms_list = []
+    for chunk_terms, _, _ in results:
+        expanded_terms_list += chunk_terms
+    failures = [
+        (i, elapsed, e) for i, (_, e, elapsed) in enumerate(results) if e is not None
+    ]
+    if failures:
+        logger.warning(
+            "failed to access medical vocab mapping service for %d of %d chunks, "
+            "returning original named entities for those chunks. "
+            "Chunk latencies: %s. Failures: %s"
+            % (
+                len(failures),
+                len(chunks),
+                ", ".join("%.3fs" % elapsed for _, _, elapsed in results),
+                "; ".join(
+                    "chunk %d after %.3fs: %r" % failure for failure in failures
+                ),
+            )
         )
-        return pretty_names
+    return pretty_names + expanded_terms_list
 
 
-def extract_and_expand_entities(medcat_annotations: dict):
-    """Given a dict of named entities from MedCAT, extract the medical entities,
+async def extract_and_expand_entities(medcat_entities: list[Entity]):
+    """Given a list of named entities from MedCAT, extract the medical entities,
     call the medical concept mapping service to add related terms, return a single
     list of strings containing all the named entities and related medical concepts.
     """
-    medical_terms, other_terms = extract_medical_entities(medcat_annotations)
+    medical_terms, other_terms = await run_in_threadpool(
+        extract_medical_entities, medcat_entities
+    )
     # Uncomment to run with MVCM
-    expanded_terms_list = call_mvcm(medical_terms)
+    expanded_terms_list = await call_mvcm(
+        [t.pretty_name for t in medical_terms.values()]
+    )
     # Uncomment to disable MVCM
-    # expanded_terms_list = [t["pretty_name"] for t in medical_terms.values()]
-    other_terms_list = [t["pretty_name"] for t in other_terms.values()]
+    # expanded_terms_list = [t.pretty_name for t in medical_terms.values()]
+    other_terms_list = [t.pretty_name for t in other_terms.values()]
     all_terms_list = expanded_terms_list + other_terms_list
     return all_terms_list
 
 
+def sort_terms(terms):
+    """Return the de-duplicated terms in sorted order."""
+    return sorted(set(terms))
+
+
+async def extract_document_terms(document: str):
+    """Run named entity recognition and concept expansion on a single document
+    and return the sorted, de-duplicated list of terms.
+    """
+    medcat_entities = await call_medcat(document)
+    return await run_in_threadpool(
+        sort_terms, await extract_and_expand_entities(medcat_entities)
+    )
+
+
+async def extract_bulk_terms(documents: list[str]):
+    """Run named entity recognition on documents in one MedCAT call, then expand
+    the entities of each document in turn. Return one sorted, de-duplicated list
+    of terms per document.
+    """
+    medcat_entities = await call_medcat_bulk(documents)
+    medical_names, other_names = await run_in_threadpool(
+        extract_bulk_entity_names, medcat_entities
+    )
+    all_terms = []
+    for dataset_medical, dataset_other in zip(medical_names, other_names):
+        expanded_terms = await call_mvcm(dataset_medical)
+        all_terms.append(
+            await run_in_threadpool(sort_terms, expanded_terms + dataset_other)
+        )
+    return all_terms
+
+
+class ClientDisconnected(Exception):
+    """Raised when the caller goes away before its request has been served."""
+
+
+async def cancel_and_wait(task: asyncio.Task):
+    """Cancel task and wait for it to unwind, so that its cleanup (e.g. releasing
+    pooled connections) has finished and any error raised meanwhile is logged.
+    """
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    except Exception:
+        logger.exception("error while cancelling in-flight work")
+
+
+async def cancel_on_disconnect(request: Request, coro):
+    """Await coro, polling the client connection while it runs. If the client
+    disconnects, cancel the in-flight upstream work and raise ClientDisconnected
+    so that no further calls are made on its behalf.
+    """
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+            if task in done:
+                return task.result()
+            if await request.is_disconnected():
+                await cancel_and_wait(task)
+                metrics["cancelled_requests"] += 1
+                logger.warning(
+                    "client disconnected from %s, cancelled in-flight work"
+                    % request.url.path
+                )
+                raise ClientDisconnected()
+    finally:
+        if not task.done():
+            await cancel_and_wait(task)
+
+
+@ted.exception_handler(ClientDisconnected)
+async def client_disconnected_handler(request: Request, exc: ClientDisconnected):
+    return Response(status_code=HTTP_499_CLIENT_CLOSED_REQUEST)
+
+
 @ted.get("/status", status_code=status.HTTP_200_OK)
 def read_status():
     return {"message": "OK"}
 
 
+@ted.get("/metrics", status_code=status.HTTP_200_OK)
+def read_metrics():
+    return {"pid": os.getpid(), **metrics}
+
+
 @ted.post("/datasets", status_code=status.HTTP_200_OK)
-def index_dataset(dataset: Dataset):
-    publish_message(
+async def index_dataset(dataset: Dataset, request: Request):
+    await run_in_threadpool(
+        publish_message,
         action_type="POST",
         action_name="datasets",
         description="Extract entities on a single dataset",
     )
 
     st = time.time()
-    document = preprocess_dataset(dataset)
-    medcat_resp = call_medcat(document)
-    all_terms_list = sorted(
-        list(set(extract_and_expand_entities(medcat_resp["result"]["annotations"])))
+    document = await run_in_threadpool(preprocess_dataset, dataset)
+    all_terms_list = await cancel_on_disconnect(
+        request, extract_document_terms(document)
     )
     et = time.time()
     elapsed = et - st
@@ -257,17 +673,17 @@ def index_dataset(dataset: Dataset):
 
 
 @ted.post("/summary", status_code=status.HTTP_200_OK)
-def index_summary(summary: Summary):
-    publish_message(
+async def index_summary(summary: Summary, request: Request):
+    await run_in_threadpool(
+        publish_message,
         action_type="POST",
         action_name="summary",
         description="Extract entities from a dataset metadata summary only",
     )
     st = time.time()
-    document = preprocess_summary(summary)
-    medcat_resp = call_medcat(document)
-    all_terms_list = sorted(
-        list(set(extract_and_expand_entities(medcat_resp["result"]["annotations"])))
+    document = await run_in_threadpool(preprocess_summary, summary)
+    all_terms_list = await cancel_on_disconnect(
+        request, extract_document_terms(document)
     )
     et = time.time()
     elapsed = et - st
@@ -276,23 +692,18 @@ def index_summary(summary: Summary):
 
 
 @ted.post("/datasets_bulk", status_code=status.HTTP_200_OK)
-def index_datasets_bulk(datasets: list[Dataset]):
+async def index_datasets_bulk(datasets: list[Dataset], request: Request):
     print(
-        publish_message(
+        await run_in_threadpool(
+            publish_message,
             action_type="POST",
             action_name="datasets",
             description="Extract entities on multiple datasets",
         )
     )
     st = time.time()
-    documents = [preprocess_dataset(dataset) for dataset in datasets]
-    medcat_resp = call_medcat_bulk(documents)
-    all_terms = []
-    for dataset_resp in medcat_resp["result"]:
-        dataset_terms_list = sorted(
-            list(set(extract_and_expand_entities(dataset_resp["annotations"])))
-        )
-        all_terms.append(dataset_terms_list)
+    documents = await run_in_threadpool(preprocess_datasets, datasets)
+    all_terms = await cancel_on_disconnect(request, extract_bulk_terms(documents))
     extracted_terms = []
     for dataset, terms in zip(datasets, all_terms):
         extracted_terms.append(
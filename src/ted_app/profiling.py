@@ -0,0 +1,298 @@
+from fastapi import APIRouter, HTTPException, status
+from fastapi.responses import PlainTextResponse
+from starlette.concurrency import run_in_threadpool as starlette_run_in_threadpool
+
+from collections import Counter
+from contextvars import ContextVar
+import inspect
+import itertools
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+import logging
+
+PROFILING_ENABLED = (
+    True if os.environ.get("PROFILING_ENABLED", False) in [1, "1"] else False
+)
+PROFILE_SAMPLE_RATE = int(os.getenv("PROFILE_SAMPLE_RATE", 0))
+PROFILE_HEADER = os.getenv("PROFILE_HEADER", "X-TED-Profile")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/ted_profiles")
+PROFILE_INTERVAL_SECONDS = float(os.getenv("PROFILE_INTERVAL_SECONDS", 0.005))
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", 100))
+
+PROFILE_SUFFIX = ".collapsed"
+PROFILE_HEADER_VALUES = (b"1", b"true", b"yes")
+
+logger = logging.getLogger(__name__)
+
+
+CO_ANY_COROUTINE = (
+    inspect.CO_COROUTINE | inspect.CO_ITERABLE_COROUTINE | inspect.CO_ASYNC_GENERATOR
+)
+
+
+def loop_driver_codes(frame) -> set:
+    """Return the code objects of the frames below the outermost coroutine in the
+    stack of frame, i.e. those of the event loop running the current task.
+    """
+    codes = set()
+    in_task = False
+    while frame is not None:
+        if frame.f_code.co_flags & CO_ANY_COROUTINE:
+            in_task = True
+        elif in_task:
+            codes.add(frame.f_code)
+        frame = frame.f_back
+    return codes
+
+
+def is_idle_frame(frame, loop_codes: set) -> bool:
+    """The event loop is waiting for I/O rather than doing work for a request.
+
+    With the pure Python event loop, the innermost frame is then the selector's
+    select. With uvloop, whose loop is written in C, it is the Python frame that
+    started the loop.
+    """
+    code = frame.f_code
+    if code in loop_codes:
+        return True
+    return code.co_name == "select" and code.co_filename.endswith("selectors.py")
+
+
+def collapse_stack(frame) -> str:
+    """Format a stack as `outermost;...;innermost` frames, as used by
+    flamegraph.pl and speedscope.
+    """
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append("%s:%s" % (code.co_filename, code.co_name))
+        frame = frame.f_back
+    return ";".join(reversed(frames))
+
+
+class StackSampler:
+    """Periodically sample, from a background thread, the stack of the event loop
+    thread and of the worker threads currently running work for the profiled
+    request, and count the collapsed stacks seen.
+    """
+
+    def __init__(self, thread_id: int, interval_seconds: float, loop_codes: set):
+        self.thread_id = thread_id
+        self.interval_seconds = interval_seconds
+        self.loop_codes = loop_codes
+        self.worker_thread_ids = set()
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval_seconds):
+            frames = sys._current_frames()
+            frame = frames.get(self.thread_id)
+            if frame is not None and not is_idle_frame(frame, self.loop_codes):
+                self.stacks[collapse_stack(frame)] += 1
+            for worker_thread_id in tuple(self.worker_thread_ids):
+                frame = frames.get(worker_thread_id)
+                if frame is not None:
+                    self.stacks[collapse_stack(frame)] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> Counter:
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+
+# The sampler of the request being served, if it is profiled
+active_sampler: ContextVar = ContextVar("active_sampler", default=None)
+
+
+async def run_in_threadpool(func, *args, **kwargs):
+    """Run func in the threadpool, like starlette's run_in_threadpool. When the
+    current request is being profiled, the worker thread is sampled while it
+    runs func.
+    """
+    sampler = active_sampler.get()
+    if sampler is None:
+        return await starlette_run_in_threadpool(func, *args, **kwargs)
+
+    def run_sampled():
+        thread_id = threading.get_ident()
+        sampler.worker_thread_ids.add(thread_id)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            sampler.worker_thread_ids.discard(thread_id)
+
+    return await starlette_run_in_threadpool(run_sampled)
+
+
+def save_profile(profile_dir: str, request_id: str, stacks: Counter):
+    os.makedirs(profile_dir, exist_ok=True)
+    path = os.path.join(profile_dir, request_id + PROFILE_SUFFIX)
+    with open(path, "w") as f:
+        for stack, count in stacks.most_common():
+            f.write("%s %d\n" % (stack, count))
+    # Only keep the most recent profiles. Workers share profile_dir, so another
+    # worker may already have removed a file.
+    for old_path, _ in list_profiles(profile_dir)[PROFILE_MAX_FILES:]:
+        try:
+            os.remove(old_path)
+        except FileNotFoundError:
+            pass
+
+
+def list_profiles(profile_dir: str):
+    """Return the paths and modification times of saved profiles, most recent
+    first.
+    """
+    if not os.path.isdir(profile_dir):
+        return []
+    profiles = []
+    for name in os.listdir(profile_dir):
+        if name.endswith(PROFILE_SUFFIX):
+            path = os.path.join(profile_dir, name)
+            try:
+                profiles.append((path, os.path.getmtime(path)))
+            except FileNotFoundError:
+                pass
+    return sorted(profiles, key=lambda profile: profile[1], reverse=True)
+
+
+def top_functions(path: str, n: int = 10):
+    """Return the n functions with the most samples at the top of the stack in
+    a collapsed stack profile, as (function, samples) pairs.
+    """
+    self_samples = Counter()
+    with open(path) as f:
+        for line in f:
+            stack, count = line.rstrip("\n").rsplit(" ", 1)
+            self_samples[stack.rsplit(";", 1)[-1]] += int(count)
+    return self_samples.most_common(n)
+
+
+class ProfilingMiddleware:
+    """Profile the requests that carry the profiling header, and one in every
+    sample_rate other requests, by sampling the event loop thread while they
+    are served, along with the threadpool work they start through
+    run_in_threadpool. Each profile is saved to profile_dir as collapsed stacks
+    named after the request id, which is returned in the profiling header.
+
+    Concurrent requests served by the same worker appear in each other's
+    profiles while they run on the event loop.
+    """
+
+    def __init__(
+        self,
+        app,
+        profile_dir: str = PROFILE_DIR,
+        sample_rate: int = PROFILE_SAMPLE_RATE,
+        interval_seconds: float = PROFILE_INTERVAL_SECONDS,
+        header: str = PROFILE_HEADER,
+    ):
+        self.app = app
+        self.profile_dir = profile_dir
+        self.sample_rate = sample_rate
+        self.interval_seconds = interval_seconds
+        self.header = header.lower().encode("latin-1")
+        self.counter = itertools.count(1)
+
+    def should_profile(self, scope) -> bool:
+        for key, value in scope["headers"]:
+            if key == self.header:
+                return value.strip().lower() in PROFILE_HEADER_VALUES
+        return self.sample_rate > 0 and next(self.counter) % self.sample_rate == 0
+
+    def request_id(self, scope) -> str:
+        for key, value in scope["headers"]:
+            if key == b"x-request-id":
+                request_id = re.sub(r"[^A-Za-z0-9_-]", "", value.decode("latin-1"))
+                if request_id:
+                    return request_id
+        return uuid.uuid4().hex
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        request_id = self.request_id(scope)
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((self.header, request_id.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        sampler = StackSampler(
+            threading.get_ident(),
+            self.interval_seconds,
+            loop_driver_codes(sys._getframe()),
+        )
+        st = time.time()
+        sampler.start()
+        token = active_sampler.set(sampler)
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            active_sampler.reset(token)
+            stacks = sampler.stop()
+            try:
+                await starlette_run_in_threadpool(
+                    save_profile, self.profile_dir, request_id, stacks
+                )
+            except OSError as e:
+                logger.warning("failed to save profile %s: %r" % (request_id, e))
+            else:
+                logger.info(
+                    "saved profile %s of %s (%d samples in %fs)"
+                    % (
+                        request_id,
+                        scope["path"],
+                        sum(stacks.values()),
+                        time.time() - st,
+                    )
+                )
+
+
+router = APIRouter(prefix="/debug/profiles")
+
+
+@router.get("", status_code=status.HTTP_200_OK)
+def read_profiles(limit: int = 20):
+    profiles = []
+    for path, mtime in list_profiles(PROFILE_DIR)[:limit]:
+        try:
+            functions = top_functions(path)
+        except FileNotFoundError:
+            continue
+        profiles.append(
+            {
+                "request_id": os.path.basename(path)[: -len(PROFILE_SUFFIX)],
+                "created_at": int(mtime),
+                "top_functions": [
+                    {"function": function, "samples": samples}
+                    for function, samples in functions
+                ],
+            }
+        )
+    return profiles
+
+
+@router.get(
+    "/{request_id}", status_code=status.HTTP_200_OK, response_class=PlainTextResponse
+)
+def read_profile(request_id: str):
+    path = os.path.join(PROFILE_DIR, os.path.basename(request_id) + PROFILE_SUFFIX)
+    try:
+        with open(path) as f:
+            return f.read()
+    except FileNotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
@@ -222,7 +222,7 @@ def get_test_medcat_response():
     }
 
 
-def get_test_bulk_medcat_response():
+def get_test_bulk_medcat_response(n_datasets=1):
     return {
         "result": [
             {
@@ -232,6 +232,7 @@ def get_test_bulk_medcat_response():
                 "timestamp": "2023-08-22T00:00:00.000+00:00",
                 "elapsed_time": 0.2,
             }
+            for _ in range(n_datasets)
         ],
         "medcat_info": {},
     }
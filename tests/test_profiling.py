@@ -0,0 +1,155 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from unittest.mock import patch
+from collections import Counter
+import asyncio
+import sys
+import threading
+import time
+import uvloop
+
+from ted_app.profiling import (
+    ProfilingMiddleware,
+    StackSampler,
+    loop_driver_codes,
+    router,
+    run_in_threadpool,
+    save_profile,
+    top_functions,
+)
+
+
+def busy_work(seconds):
+    st = time.time()
+    while time.time() - st < seconds:
+        pass
+
+
+def threadpool_busy_work(seconds):
+    busy_work(seconds)
+
+
+def get_test_client(profile_dir, sample_rate=0):
+    app = FastAPI()
+    app.add_middleware(
+        ProfilingMiddleware,
+        profile_dir=str(profile_dir),
+        sample_rate=sample_rate,
+        interval_seconds=0.001,
+    )
+    app.include_router(router)
+
+    @app.get("/work")
+    async def work():
+        busy_work(0.05)
+        return {"message": "OK"}
+
+    @app.get("/threadpool_work")
+    async def threadpool_work():
+        await run_in_threadpool(threadpool_busy_work, 0.05)
+        return {"message": "OK"}
+
+    return TestClient(app)
+
+
+def test_profile_requested_by_header(tmp_path):
+    client = get_test_client(tmp_path)
+
+    response = client.get("/work")
+    assert "x-ted-profile" not in response.headers
+    response = client.get("/work", headers={"X-TED-Profile": "0"})
+    assert "x-ted-profile" not in response.headers
+    assert list(tmp_path.iterdir()) == []
+
+    response = client.get(
+        "/work", headers={"X-TED-Profile": "1", "X-Request-ID": "abc-123"}
+    )
+    assert response.status_code == 200
+    assert response.headers["x-ted-profile"] == "abc-123"
+
+    profile_path = tmp_path / "abc-123.collapsed"
+    functions = [function for function, _ in top_functions(profile_path)]
+    assert functions[0].endswith("test_profiling.py:busy_work")
+
+    with patch("ted_app.profiling.PROFILE_DIR", str(tmp_path)):
+        profiles = client.get("/debug/profiles").json()
+        assert [p["request_id"] for p in profiles] == ["abc-123"]
+        assert profiles[0]["top_functions"][0]["function"] == functions[0]
+
+        response = client.get("/debug/profiles/abc-123")
+        assert response.text == profile_path.read_text()
+        assert client.get("/debug/profiles/unknown").status_code == 404
+
+
+def test_profile_sampling_rate(tmp_path):
+    client = get_test_client(tmp_path, sample_rate=2)
+    for _ in range(4):
+        client.get("/work")
+
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_stack_sampler_skips_idle_loop():
+    async def wait_then_work():
+        sampler = StackSampler(
+            threading.get_ident(), 0.001, loop_driver_codes(sys._getframe())
+        )
+        sampler.start()
+        await asyncio.sleep(0.2)
+        busy_work(0.05)
+        return sampler.stop()
+
+    for new_event_loop in [asyncio.new_event_loop, uvloop.new_event_loop]:
+        loop = new_event_loop()
+        try:
+            stacks = loop.run_until_complete(wait_then_work())
+        finally:
+            loop.close()
+
+        assert sum(stacks.values()) > 0
+        assert all("test_profiling.py:wait_then_work" in stack for stack in stacks)
+
+
+def test_save_profile_concurrently(tmp_path):
+    errors = []
+
+    def save_profiles(worker):
+        try:
+            for i in range(20):
+                save_profile(str(tmp_path), "%d-%d" % (worker, i), Counter({"a;b": 1}))
+        except Exception as e:
+            errors.append(e)
+
+    with patch("ted_app.profiling.PROFILE_MAX_FILES", 2):
+        threads = [
+            threading.Thread(target=save_profiles, args=(worker,))
+            for worker in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert errors == []
+    assert len(list(tmp_path.iterdir())) <= 4 * 2
+
+
+def test_profile_includes_threadpool_work(tmp_path):
+    client = get_test_client(tmp_path)
+
+    response = client.get(
+        "/threadpool_work", headers={"X-TED-Profile": "1", "X-Request-ID": "abc"}
+    )
+    assert response.status_code == 200
+
+    profile = (tmp_path / "abc.collapsed").read_text()
+    assert "test_profiling.py:threadpool_busy_work;" in profile
+    functions = [function for function, _ in top_functions(tmp_path / "abc.collapsed")]
+    assert functions[0].endswith("test_profiling.py:busy_work")
+
+
+def test_run_in_threadpool_without_profiling():
+    async def run():
+        return await run_in_threadpool(sum, [1, 2], start=3)
+
+    assert asyncio.run(run()) == 6
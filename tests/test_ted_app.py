@@ -1,22 +1,74 @@
 import pytest
 from fastapi.testclient import TestClient
-from unittest.mock import patch, Mock
+from unittest.mock import patch, Mock, AsyncMock
 from requests.models import Response
+import asyncio
+import httpx
 import json
+import os
 
-from ted_app.main import ted, preprocess_dataset, extract_medical_entities
+from ted_app.main import (
+    ted,
+    preprocess_dataset,
+    extract_medical_entities,
+    extract_bulk_entity_names,
+    MedcatEntityParser,
+    MedcatResponseError,
+    parse_medcat_body,
+    Entity,
+    call_mvcm,
+    http_timeout,
+    cancel_on_disconnect,
+    ClientDisconnected,
+    metrics,
+)
 import ted_app
 import helpers
 
 client = TestClient(ted)
 
 
+def get_mock_http_client(medcat_response, mvcm_response, medcat_status=200):
+    def handler(request):
+        if request.url.host == "medcat":
+            return httpx.Response(medcat_status, json=medcat_response)
+        return httpx.Response(200, json=mvcm_response)
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def parse_test_entities(medcat_response, bulk=False, chunk_size=None):
+    body = json.dumps(medcat_response).encode("utf-8")
+    chunk_size = chunk_size or len(body)
+    parser = MedcatEntityParser(bulk)
+    for i in range(0, len(body), chunk_size):
+        parser.feed(body[i : i + chunk_size])
+    return parser.close()
+
+
 def test_read_status():
     response = client.get("/status")
     assert response.status_code == 200
     assert response.json() == {"message": "OK"}
 
 
+def test_read_metrics():
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.json() == {
+        "pid": os.getpid(),
+        "cancelled_requests": metrics["cancelled_requests"],
+    }
+
+
+@patch("ted_app.main.HTTP_POOL_TIMEOUT_SECONDS", 5.0)
+def test_http_timeout():
+    timeout = http_timeout(600)
+    assert timeout.read == 600
+    assert timeout.pool == 5.0
+    assert http_timeout(None).pool == 5.0
+
+
 def test_preprocess_dataset():
     test_dataset = helpers.get_test_dataset()
     document = preprocess_dataset(test_dataset)
@@ -31,8 +83,8 @@ def test_preprocess_dataset():
 
 
 def test_extract_medical_entities():
-    fake_annotations = helpers.get_test_annotations()
-    medical_terms, other_terms = extract_medical_entities(fake_annotations)
+    fake_entities = parse_test_entities(helpers.get_test_medcat_response())[0]
+    medical_terms, other_terms = extract_medical_entities(fake_entities)
 
     assert len(medical_terms) == 1
     assert "1" in medical_terms.keys()
@@ -42,14 +94,122 @@ def test_extract_medical_entities():
     assert "3" not in other_terms.keys()
 
 
+def test_extract_bulk_entity_names():
+    fake_entities = parse_test_entities(helpers.get_test_medcat_response())[0]
+    medical_names, other_names = extract_bulk_entity_names([fake_entities] * 2)
+
+    assert medical_names == [["Diabetes"], ["Diabetes"]]
+    assert other_names == [["Data Set"], ["Data Set"]]
+
+
+def test_medcat_entity_parser():
+    expected_entities = [
+        Entity("1", "Diabetes", ("Disease or Syndrome",), "Affirmed"),
+        Entity("2", "Data Set", ("Itellectual Product",), "Affirmed"),
+        Entity("3", "Documents", ("Itellectual Product",), "Other"),
+    ]
+
+    entities = parse_test_entities(helpers.get_test_medcat_response(), chunk_size=7)
+    assert entities == [expected_entities]
+
+    bulk_response = helpers.get_test_bulk_medcat_response()
+    bulk_response["result"].append(dict(bulk_response["result"][0], annotations=[]))
+    entities = parse_test_entities(bulk_response, bulk=True, chunk_size=7)
+    assert entities == [expected_entities, []]
+
+    with pytest.raises(MedcatResponseError):
+        parse_test_entities({"error": "Internal Server Error"})
+
+
+def test_parse_medcat_body():
+    medcat_response = helpers.get_test_medcat_response()
+    body = json.dumps(medcat_response).encode("utf-8")
+    assert parse_medcat_body(body) == parse_test_entities(medcat_response)
+
+    bulk_response = helpers.get_test_bulk_medcat_response(n_datasets=2)
+    body = json.dumps(bulk_response).encode("utf-8")
+    assert parse_medcat_body(body, bulk=True) == parse_test_entities(
+        bulk_response, bulk=True
+    )
+
+    with pytest.raises(MedcatResponseError):
+        parse_medcat_body(b'{"error": "Internal Server Error"}')
+
+
+@patch("ted_app.main.MVCM_CHUNK_SIZE", 1)
+@patch("httpx.AsyncClient.post", new_callable=AsyncMock)
+def test_call_mvcm_failed_chunk(mock_post):
+    def fake_mvcm(url, json, auth):
+        if json["search_terms"] == ["Data Set"]:
+            raise ConnectionError("MVCM unavailable")
+        mock_response = Mock()
+        mock_response.json.return_value = helpers.get_test_mvcm_response()[:1]
+        return mock_response
+
+    mock_post.side_effect = fake_mvcm
+
+    terms = asyncio.run(call_mvcm(["Diabetes", "Data Set"]))
+
+    assert mock_post.call_count == 2
+    assert terms[:2] == ["Diabetes", "Data Set"]
+    assert "Disorder of endocrine system" in terms
+
+
+@patch("ted_app.main.MVCM_HOST", "http://mvcm")
+@patch("ted_app.main.MVCM_USER", "user")
+@patch("ted_app.main.MVCM_PASSWORD", "password")
+@patch("ted_app.main.get_http_client")
+def test_call_mvcm_error_status(mock_get_http_client, caplog):
+    mock_get_http_client.return_value = httpx.AsyncClient(
+        transport=httpx.MockTransport(lambda request: httpx.Response(500, json=[]))
+    )
+
+    terms = asyncio.run(call_mvcm(["Diabetes"]))
+
+    assert terms == ["Diabetes"]
+    assert "for 1 of 1 chunks" in caplog.text
+
+
+@patch("ted_app.main.MVCM_CHUNK_SIZE", 1)
+@patch("ted_app.main.MVCM_MAX_CONCURRENCY", 2)
+@patch("httpx.AsyncClient.post", new_callable=AsyncMock)
+def test_call_mvcm_concurrency_per_worker(mock_post):
+    in_flight = []
+    max_in_flight = []
+
+    async def fake_mvcm(url, json, auth):
+        in_flight.append(json)
+        max_in_flight.append(len(in_flight))
+        await asyncio.sleep(0.01)
+        in_flight.remove(json)
+        mock_response = Mock()
+        mock_response.json.return_value = []
+        return mock_response
+
+    mock_post.side_effect = fake_mvcm
+
+    async def concurrent_requests():
+        return await asyncio.gather(
+            call_mvcm(["Diabetes", "Data Set"]), call_mvcm(["Asthma", "Dataset"])
+        )
+
+    asyncio.run(concurrent_requests())
+
+    assert mock_post.call_count == 4
+    assert max(max_in_flight) == 2
+
+
 # Comment out if MVCM enabled
-@patch("ted_app.main.requests.post")
+@patch("ted_app.main.MEDCAT_HOST", "http://medcat")
+@patch("ted_app.main.MVCM_HOST", "http://mvcm")
+@patch("ted_app.main.MVCM_USER", "user")
+@patch("ted_app.main.MVCM_PASSWORD", "password")
+@patch("ted_app.main.get_http_client")
 # @pytest.mark.xfail
-def test_index_dataset(mock_post):
-    mock_responses = [Mock(), Mock()]
-    mock_responses[0].json.return_value = helpers.get_test_medcat_response()
-    mock_responses[1].json.return_value = helpers.get_test_mvcm_response()
-    mock_post.side_effect = mock_responses
+def test_index_dataset(mock_get_http_client):
+    mock_get_http_client.return_value = get_mock_http_client(
+        helpers.get_test_medcat_response(), helpers.get_test_mvcm_response()
+    )
 
     test_dataset = helpers.get_test_json_dataset()
 
@@ -74,20 +234,27 @@ def test_index_dataset(mock_post):
 
 
 # Comment out if MVCM enabled
-@patch("ted_app.main.requests.post")
+@patch("ted_app.main.MEDCAT_HOST", "http://medcat")
+@patch("ted_app.main.MVCM_HOST", "http://mvcm")
+@patch("ted_app.main.MVCM_USER", "user")
+@patch("ted_app.main.MVCM_PASSWORD", "password")
+@patch("ted_app.main.get_http_client")
 # @pytest.mark.xfail
-def test_index_datasets(mock_post):
-    mock_responses = [Mock(), Mock()]
-    mock_responses[0].json.return_value = helpers.get_test_bulk_medcat_response()
-    mock_responses[1].json.return_value = helpers.get_test_mvcm_response()
-    mock_post.side_effect = mock_responses
+@pytest.mark.parametrize("stream_min_bytes", [16 * 1024 * 1024, 0])
+def test_index_datasets(mock_get_http_client, stream_min_bytes):
+    mock_get_http_client.return_value = get_mock_http_client(
+        helpers.get_test_bulk_medcat_response(n_datasets=2),
+        helpers.get_test_mvcm_response(),
+    )
 
     test_dataset = helpers.get_test_json_dataset()
 
-    response = client.post("/datasets_bulk", json=[test_dataset, test_dataset])
+    with patch("ted_app.main.MEDCAT_STREAM_MIN_BYTES", stream_min_bytes):
+        response = client.post("/datasets_bulk", json=[test_dataset, test_dataset])
     assert response.status_code == 200
 
     response_arr = response.json()
+    assert len(response_arr) == 2
     for dataset_resp in response_arr:
         assert dataset_resp == {
             "id": "1111",
@@ -102,3 +269,58 @@ def test_index_datasets(mock_post):
                 "Disorder of endocrine system",
             ],
         }
+
+
+def test_cancel_on_disconnect():
+    upstream_cancelled = []
+
+    async def slow_upstream_call():
+        try:
+            await asyncio.sleep(600)
+        except asyncio.CancelledError:
+            upstream_cancelled.append(True)
+            raise
+
+    mock_request = Mock()
+    mock_request.is_disconnected = AsyncMock(return_value=True)
+    mock_request.url.path = "/datasets"
+
+    async def disconnected_request():
+        with pytest.raises(ClientDisconnected):
+            await cancel_on_disconnect(mock_request, slow_upstream_call())
+        # The upstream work has finished unwinding by the time the error is raised
+        assert upstream_cancelled == [True]
+
+    cancelled_before = metrics["cancelled_requests"]
+    with patch("ted_app.main.DISCONNECT_POLL_SECONDS", 0.01):
+        asyncio.run(disconnected_request())
+
+    assert metrics["cancelled_requests"] == cancelled_before + 1
+
+
+@patch("ted_app.main.MEDCAT_HOST", "http://medcat")
+@patch("ted_app.main.get_http_client")
+def test_index_dataset_medcat_error(mock_get_http_client):
+    mock_get_http_client.return_value = get_mock_http_client(
+        {"error": "Internal Server Error"}, [], medcat_status=500
+    )
+    error_client = TestClient(ted, raise_server_exceptions=False)
+
+    test_dataset = helpers.get_test_json_dataset()
+
+    response = error_client.post("/datasets", json=test_dataset)
+    assert response.status_code == 500
+
+
+@patch("ted_app.main.MEDCAT_HOST", "http://medcat")
+@patch("ted_app.main.get_http_client")
+def test_index_datasets_missing_medcat_results(mock_get_http_client):
+    mock_get_http_client.return_value = get_mock_http_client(
+        helpers.get_test_bulk_medcat_response(), []
+    )
+    error_client = TestClient(ted, raise_server_exceptions=False)
+
+    test_dataset = helpers.get_test_json_dataset()
+
+    response = error_client.post("/datasets_bulk", json=[test_dataset, test_dataset])
+    assert response.status_code == 500